@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Ahead-of-time compilation of the RGB enhancement kernel.
+
+Builds the mapchete_safe._rgb_enhance extension module, which can be imported
+without numba's JIT warm-up in every worker process. Run this script from a
+source checkout before installing:
+
+    python build_kernel.py
+
+The module records a checksum of mapchete_safe/_kernels.py, so the example
+process ignores a build which does not match the current kernels.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+
+PACKAGE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "mapchete_safe"
+)
+
+
+def main():
+    """Compile kernels into mapchete_safe/_rgb_enhance."""
+    # JIT cache entries of mapchete_safe._kernels cannot be loaded when
+    # importing the kernels as standalone module, so keep them apart
+    cache_dir = tempfile.mkdtemp()
+    os.environ["NUMBA_CACHE_DIR"] = cache_dir
+    try:
+        from numba.pycc import CC
+
+        # import kernels without mapchete_safe/__init__.py and its GDAL
+        # dependencies
+        sys.path.insert(0, PACKAGE_DIR)
+        from _kernels import _enhance_pixel, _lookup_tables
+
+        with open(os.path.join(PACKAGE_DIR, "_kernels.py"), "rb") as src:
+            checksum = zlib.crc32(src.read()) & 0xffffffff
+
+        cc = CC("_rgb_enhance")
+        cc.output_dir = PACKAGE_DIR
+
+        @cc.export("kernels_checksum", "i8()")
+        def kernels_checksum():
+            """CRC32 of the _kernels.py this module was built from."""
+            return checksum
+
+        @cc.export(
+            "enhance_rgb_u16_u8",
+            "void(u2[:,:,:], b1[:,:], f4, f4, f4, f4, f4, f4, u1[:,:,:])"
+        )
+        def enhance_rgb_u16_u8(
+            rgb_u16, mask, r_gamma, g_gamma, b_gamma, contrast, bias, sat, out
+        ):
+            """Serial version of mapchete_safe._kernels.enhance_rgb."""
+            lut = _lookup_tables(r_gamma, g_gamma, b_gamma, contrast, bias)
+            height, width = mask.shape
+            for i in range(height):
+                for j in range(width):
+                    _enhance_pixel(rgb_u16, mask, lut, sat, out, i, j)
+
+        cc.compile()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,41 @@
 #!/usr/bin/env python
 """Extract and enhance Sentinel-2 RGB data."""
 
+import math
+import os
+import zlib
 from mapchete.errors import MapcheteEmptyInputTile
-from rio_color.operations import sigmoidal, gamma, saturation
 import numpy as np
+import numpy.ma as ma
+
+
+def _precompiled_kernel():
+    """Return kernel precompiled by build_kernel.py if it is up to date."""
+    try:
+        from mapchete_safe import _rgb_enhance
+    except ImportError:
+        return None
+    with open(
+        os.path.join(os.path.dirname(_rgb_enhance.__file__), "_kernels.py"),
+        "rb"
+    ) as src:
+        checksum = zlib.crc32(src.read()) & 0xffffffff
+    # ignore builds of other kernel versions
+    if getattr(_rgb_enhance, "kernels_checksum", lambda: None)() == checksum:
+        return _rgb_enhance.enhance_rgb_u16_u8
+    return None
+
+
+enhance_rgb = _precompiled_kernel()
+if enhance_rgb is None:
+    try:
+        from mapchete_safe._kernels import enhance_rgb
+    except ImportError:
+        enhance_rgb = None
+
+# rows per block of the NumPy fallback; a 3 band float32 block of 64 rows
+# of a 1024 pixel wide tile is 768 KB and fits into L2 cache
+BLOCK_ROWS = 64
 
 
 def execute(mp):
@@ -13,44 +45,164 @@ def execute(mp):
         "input_file", resampling=mp.params["resampling"]
     ) as safe_file:
         try:
-            # read red, green and blue bands & scale to 8 bit
-            rgb = np.clip(
-                safe_file.read(
-                    [4, 3, 2],
-                    mask_clouds=mp.params["mask_clouds"],
-                    mask_white_areas=mp.params["mask_white_areas"]
-                ) / 16, 0, 255
-            ).astype("uint8")
+            # read red, green and blue bands
+            rgb = safe_file.read(
+                [4, 3, 2],
+                mask_clouds=mp.params["mask_clouds"],
+                mask_white_areas=mp.params["mask_white_areas"]
+            )
         except MapcheteEmptyInputTile:
             return "empty"
 
-    # scale to 0 to 1 for filters
-    red, green, blue = rgb.astype("float") / 255
+    if enhance_rgb is None:
+        return _enhance_numpy(mp, rgb)
+
+    # scale to 8 bit, enhance colors and apply nodata mask in one pass
+    out = np.empty(rgb.shape, dtype="uint8")
+    enhance_rgb(
+        rgb.data,
+        ma.getmaskarray(rgb).any(axis=0),
+        np.float32(mp.params["red_gamma"]),
+        np.float32(mp.params["green_gamma"]),
+        np.float32(mp.params["blue_gamma"]),
+        np.float32(mp.params["sigmoidal_contrast"]),
+        np.float32(mp.params["sigmoidal_bias"]),
+        np.float32(mp.params["saturation"]),
+        out
+    )
+    return out
 
-    # save nodata mask for later & remove rgb to free memory
-    mask = rgb.mask
-    del rgb
 
-    # using rio-color:
+def _enhance_numpy(mp, rgb):
+    """Enhance RGB colors using NumPy if numba is not available."""
+    # scale to 8 bit: shifting by 4 bits is an integer division by 16
+    data = np.right_shift(rgb.data, 4, out=rgb.data)
+    np.minimum(data, 255, out=data)
+    rgb = ma.masked_array(data.astype("uint8"), mask=rgb.mask)
+    mask = ma.getmaskarray(rgb)
+
+    # gamma and sigmoidal contrast only depend on the 8 bit input value, so
+    # compute them once per band and value into lookup tables
+    luts = np.empty((3, 256), dtype=np.float32)
+    luts[:] = np.arange(256)
+    luts *= np.float32(1. / 255)
     # (1) apply gamma correction to each band individually
+    for lut, band_gamma in zip(
+        luts,
+        [
+            mp.params["red_gamma"],
+            mp.params["green_gamma"],
+            mp.params["blue_gamma"]
+        ]
+    ):
+        _gamma(lut, band_gamma, out=lut)
     # (2) add sigmoidal contrast & bias
-    # (3) add saturation
-    enhanced = np.clip(
-        saturation(
-            sigmoidal(
-                np.stack([
-                    # apply gamma correction for each band
-                    gamma(red, mp.params["red_gamma"]),
-                    gamma(green, mp.params["green_gamma"]),
-                    gamma(blue, mp.params["blue_gamma"]),
-                ]),
-                mp.params["sigmoidal_contrast"],
-                mp.params["sigmoidal_bias"]
-            ),
-            mp.params["saturation"]
-        ) * 255,    # scale back to 8bit
-        1, 255      # clip valid values from 1 to 255
+    _sigmoidal(
+        luts,
+        mp.params["sigmoidal_contrast"],
+        mp.params["sigmoidal_bias"],
+        out=luts
     )
+    # float32 rounding may leave the valid range from 0 to 1
+    np.clip(luts, 0, 1, out=luts)
+
+    out = np.empty(rgb.shape, dtype="uint8")
+
+    # process blocks of rows small enough to keep all steps in cache; the
+    # same float32 buffers are reused for all steps and blocks
+    _, height, width = rgb.shape
+    scratch = np.empty((3, BLOCK_ROWS, width), dtype=np.float32)
+    saturation_scratch = np.empty((3, BLOCK_ROWS, width), dtype=np.float32)
+    for row in range(0, height, BLOCK_ROWS):
+        rows = slice(row, min(row + BLOCK_ROWS, height))
+        enhanced = scratch[:, :rows.stop - rows.start]
+
+        # look up gamma & sigmoidal values
+        for band, lut, band_data in zip(enhanced, luts, rgb.data[:, rows]):
+            np.take(lut, band_data, out=band)
+
+        # (3) add saturation
+        _saturation_inplace(
+            enhanced,
+            mp.params["saturation"],
+            saturation_scratch[:, :rows.stop - rows.start]
+        )
+
+        # scale back to 8bit & clip valid values from 1 to 255
+        np.multiply(enhanced, 255, out=enhanced)
+        np.clip(enhanced, 1, 255, out=enhanced)
+
+        out[:, rows] = enhanced
+
+    # use original nodata mask
+    out[mask] = 0
+    return out
+
+
+def _gamma(arr, g, out):
+    """Apply gamma correction like rio-color into out."""
+    if g <= 0:
+        raise ValueError("gamma must be greater than 0")
+    return np.power(arr, 1. / g, out=out)
+
+
+def _sigmoidal(arr, contrast, bias, out):
+    """Apply sigmoidal contrast & bias like rio-color into out."""
+    if contrast < 0:
+        raise ValueError("contrast must not be negative")
+    elif contrast == 0:
+        out[:] = arr
+        return out
+    bias = bias or 1e-7
+    sig_min = 1. / (1. + math.exp(contrast * bias))
+    sig_scale = 1. / (1. / (1. + math.exp(contrast * (bias - 1.))) - sig_min)
+    np.subtract(bias, arr, out=out)
+    np.multiply(out, contrast, out=out)
+    np.exp(out, out=out)
+    np.add(out, 1., out=out)
+    np.reciprocal(out, out=out)
+    np.subtract(out, sig_min, out=out)
+    np.multiply(out, sig_scale, out=out)
+    return out
+
+
+def _saturation_inplace(rgb, sat, scratch):
+    """
+    Scale HSL saturation of a 3 band array in place.
+
+    At constant hue and lightness, scaling HSL saturation moves each channel
+    linearly away from lightness, so no conversion to HSL and back is needed.
+    scratch has to be a float array with the same shape as rgb.
+    """
+    red, green, blue = rgb
+    chroma, lightness, factor = scratch
+
+    # maximum & minimum channel value
+    np.fmax(red, green, out=chroma)
+    np.fmax(chroma, blue, out=chroma)
+    np.fmin(red, green, out=lightness)
+    np.fmin(lightness, blue, out=lightness)
+
+    # chroma = max - min, lightness = (max + min) / 2
+    np.add(chroma, lightness, out=lightness)
+    np.multiply(chroma, 2, out=chroma)
+    np.subtract(chroma, lightness, out=chroma)
+    np.multiply(lightness, 0.5, out=lightness)
+
+    # factor = min(sat, 1 / saturation), saturation being
+    # chroma / (1 - |2 * lightness - 1|); grey pixels yield inf or nan which
+    # np.fmin ignores
+    np.multiply(lightness, 2, out=factor)
+    np.subtract(factor, 1, out=factor)
+    np.abs(factor, out=factor)
+    np.subtract(1, factor, out=factor)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(factor, chroma, out=factor)
+    np.fmin(factor, sat, out=factor)
 
-    # use original nodata mask and return
-    return np.where(mask, 0, enhanced).astype("uint8")
+    # channel = lightness + (channel - lightness) * factor
+    for band in rgb:
+        np.subtract(band, lightness, out=band)
+        np.multiply(band, factor, out=band)
+        np.add(band, lightness, out=band)
+    return rgb
@@ -1,17 +1,29 @@
 """Read bands from Seninel-2 SAFE archives."""
 
+import atexit
+import functools
+import multiprocessing
 import os
 import s2reader
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import numpy.ma as ma
+import rasterio
 from cached_property import cached_property
 from rasterio.crs import CRS
-from rasterio.features import geometry_mask
+from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from rasterio.warp import reproject
 from s2reader.s2reader import BAND_IDS
+from shapely import __version__ as shapely_version
+from shapely.strtree import STRtree
 
 from mapchete.formats import base
 from mapchete.io.vector import reproject_geometry
-from mapchete.io.raster import read_raster_window
 from mapchete.errors import MapcheteEmptyInputTile
 
 
@@ -22,6 +34,19 @@ METADATA = {
     "file_extensions": ["SAFE", "zip", "ZIP"]
 }
 
+# STRtree.query returns integer indexes instead of geometries since Shapely 2
+SHAPELY_2 = int(shapely_version.split(".")[0]) >= 2
+
+# Band datasets stay open and are reused by all tiles read in this process
+# and the thread pool is created on the first parallel read. Neither
+# survives a fork, so both are reset in a forked child process.
+DATASET_CACHE_SIZE = 64
+_datasets = OrderedDict()
+_datasets_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_pid = os.getpid()
+
 
 class InputData(base.InputData):
     """Main input class."""
@@ -54,6 +79,7 @@ class InputData(base.InputData):
                             src_crs=CRS.from_epsg(4326),
                             dst_crs=self.crs
                         ),
+                        "footprint_4326": granule.footprint,
                         "nodatamask": granule.nodata_mask,
                         "cloudmask": granule.cloudmask,
                         "band_path": {
@@ -66,17 +92,38 @@ class InputData(base.InputData):
                     for granule in s2dataset.granules
                 ]
             }
+        # granule masks are only reprojected once a tile intersects them
+        self._reprojected = {}
+
+    def __getstate__(self):
+        """Drop spatial index, it is rebuilt in the unpickling process."""
+        state = self.__dict__.copy()
+        state.pop("_granule_index", None)
+        return state
+
+    @cached_property
+    def _granule_index(self):
+        """Spatial index of granule footprints in EPSG:4326."""
+        footprints = [
+            granule["footprint_4326"]
+            for granule in self.s2metadata["granules"]
+        ]
+        # Shapely < 2 returns the geometries themselves on query, so map the
+        # footprint objects of this process back to their granule position
+        return (
+            STRtree(footprints),
+            {
+                id(footprint): index
+                for index, footprint in enumerate(footprints)
+            }
+        )
 
     @cached_property
     def cloudmask(self):
         """SAFE file cloud mask as iterable list of geometries."""
         return [
-            reproject_geometry(
-                granule["cloudmask"],
-                src_crs=CRS.from_epsg(4326),
-                dst_crs=self.crs
-            )
-            for granule in self.s2metadata["granules"]
+            self._granule_geometry(index, "cloudmask")
+            for index, granule in enumerate(self.s2metadata["granules"])
             if not granule["cloudmask"].is_empty
         ]
 
@@ -84,26 +131,30 @@ class InputData(base.InputData):
     def nodatamask(self):
         """SAFE file nodata mask as iterable list of geometries."""
         return [
-            reproject_geometry(
-                granule["nodatamask"],
-                src_crs=CRS.from_epsg(4326),
-                dst_crs=self.crs
-            )
-            for granule in self.s2metadata["granules"]
+            self._granule_geometry(index, "nodatamask")
+            for index in range(len(self.s2metadata["granules"]))
         ]
 
     def open(self, tile, **kwargs):
         """Return InputTile."""
+        granule_indexes = self._intersecting_granule_indexes(tile.bbox)
+        cloudmask = [
+            self._granule_geometry(index, "cloudmask").intersection(tile.bbox)
+            for index in granule_indexes
+            if not self.s2metadata["granules"][index]["cloudmask"].is_empty
+        ]
         return InputTile(
             tile,
             self,
             s2metadata=self.s2metadata,
-            cloudmask=[
-                j
-                for j in [i.intersection(tile.bbox) for i in self.cloudmask]
-                if not j.is_empty
+            granules=[
+                self.s2metadata["granules"][index] for index in granule_indexes
+            ],
+            cloudmask=[i for i in cloudmask if not i.is_empty],
+            nodatamask=[
+                self._granule_geometry(index, "nodatamask")
+                for index in granule_indexes
             ],
-            nodatamask=self.nodatamask,
             **kwargs
         )
 
@@ -122,25 +173,67 @@ class InputData(base.InputData):
         """Check whether input file exists."""
         return os.path.isfile(self.path)
 
+    def _granule_geometry(self, index, key):
+        """Return granule geometry reprojected to pyramid CRS."""
+        if (index, key) not in self._reprojected:
+            self._reprojected[(index, key)] = reproject_geometry(
+                self.s2metadata["granules"][index][key],
+                src_crs=CRS.from_epsg(4326),
+                dst_crs=self.crs
+            )
+        return self._reprojected[(index, key)]
+
+    def _intersecting_granule_indexes(self, geometry):
+        """Return indexes of granules intersecting with geometry."""
+        tree, footprint_indexes = self._granule_index
+        candidates = tree.query(
+            reproject_geometry(
+                geometry, src_crs=self.crs, dst_crs=CRS.from_epsg(4326)
+            )
+        )
+        if not SHAPELY_2:
+            candidates = [footprint_indexes[id(c)] for c in candidates]
+        return [
+            index
+            for index in sorted(int(candidate) for candidate in candidates)
+            if self.s2metadata["granules"][index]["footprint"].intersects(
+                geometry
+            )
+        ]
+
+    def _intersecting_granules(self, geometry):
+        """Return granules whose footprints intersect with geometry."""
+        return [
+            self.s2metadata["granules"][index]
+            for index in self._intersecting_granule_indexes(geometry)
+        ]
+
 
 class InputTile(base.InputTile):
     """Target Tile representation of input data."""
 
     def __init__(
-        self, tile, safe_file, s2metadata=None, cloudmask=None,
+        self, tile, safe_file, s2metadata=None, granules=None, cloudmask=None,
         nodatamask=None, resampling="nearest"
     ):
         """Initialize."""
         self.tile = tile
         self.safe_file = safe_file
         self.s2metadata = s2metadata
+        # granules intersecting with tile, looked up once by InputData.open()
+        self.granules = (
+            safe_file._intersecting_granules(tile.bbox)
+            if granules is None else granules
+        )
         self.cloudmask = cloudmask
         self.nodatamask = nodatamask
         self.resampling = resampling
         self.dtype = "uint16"
 
-    def _empty(self, height):
-        return ma.masked_array(np.zeros(height + (self.tile.shape, )), True)
+    def _empty(self, count):
+        return ma.masked_array(
+            np.zeros((count, ) + self.tile.shape, dtype=self.dtype), True
+        )
 
     def read(
         self,
@@ -186,38 +279,15 @@ class InputTile(base.InputTile):
             else:
                 raise MapcheteEmptyInputTile
 
-        # iterate through affected granules
-        granules = [
-            granule
-            for granule in self.s2metadata["granules"]
-            if granule["footprint"].intersects(self.tile.bbox)
-        ]
-
-        # read bands from granules
-        bands = []
-        for band_index in band_indexes:
-            band = ma.masked_array(
-                ma.zeros(self.tile.shape, dtype=self.dtype), mask=True
-            )
-            for granule in granules:
-                new_data = read_raster_window(
-                    granule["band_path"][band_index],
-                    self.tile,
-                    indexes=[1],
-                    resampling=self.resampling,
-                    src_nodata=0,
-                    dst_nodata=0
-                )
-                if new_data.mask.all():
-                    continue
-                band = ma.masked_array(
-                    data=np.where(new_data == 0, band.data, new_data),
-                    mask=np.where(new_data == 0, True, False)
-                )
-            bands.append(band)
+        # read bands from affected granules
+        bands, band_masks = self._read_bands(
+            band_indexes, self.granules, resampling
+        )
 
         # get combined mask
-        mask = self._mask(bands, mask_nodata, mask_white_areas, mask_clouds)
+        mask = self._mask(
+            bands, band_masks, mask_nodata, mask_white_areas, mask_clouds
+        )
         # skip if emtpy
         if mask.all():
             if return_empty:
@@ -225,24 +295,79 @@ class InputTile(base.InputTile):
             else:
                 raise MapcheteEmptyInputTile("all values masked")
         else:
-            nd_mask = np.stack([mask for _ in band_indexes])
+            bands[:, mask] = 0
             return ma.masked_array(
-                data=np.where(nd_mask, 0, np.stack(bands)),
-                mask=nd_mask
+                data=bands,
+                mask=np.repeat(mask[np.newaxis], len(band_indexes), axis=0)
             )
 
     def is_empty(self, indexes=None):
         """Quick check if tile is empty."""
-        return not self.tile.bbox.intersects(self.safe_file.bbox())
+        return not self.granules
+
+    @cached_property
+    def _cloud_mask_raster(self):
+        """Cloud mask rasterized on the tile grid or None if cloudless."""
+        if self.cloudmask:
+            cloud_mask = np.zeros(self.tile.shape, dtype=np.uint8)
+            rasterize(
+                self.cloudmask,
+                out=cloud_mask,
+                transform=self.tile.affine,
+                default_value=1
+            )
+            return cloud_mask.view(bool)
+        else:
+            return None
+
+    def _read_bands(self, band_indexes, granules, resampling):
+        """Return stacked bands and band masks merged from all granules."""
+        bands = np.zeros(
+            (len(band_indexes), ) + self.tile.shape, dtype=self.dtype
+        )
+        band_masks = np.ones(bands.shape, dtype=bool)
+
+        def _read_band(band_pos):
+            # merge granules in order, so the first granule covering a pixel
+            # wins; each window is merged right away so it can be freed
+            band, band_mask = bands[band_pos], band_masks[band_pos]
+            for granule in granules:
+                new_data = _read_band_window(
+                    granule["band_path"][band_indexes[band_pos]],
+                    self.tile,
+                    resampling
+                )
+                fill = band_mask & ~ma.getmaskarray(new_data)
+                if not fill.any():
+                    continue
+                band[fill] = new_data.data[fill]
+                band_mask[fill] = False
+
+        if min(_read_threads(), len(band_indexes)) <= 1:
+            for band_pos in range(len(band_indexes)):
+                _read_band(band_pos)
+        else:
+            # read bands in parallel; GDAL releases the GIL while reading
+            executor = _read_executor()
+            futures = [
+                executor.submit(_read_band, band_pos)
+                for band_pos in range(len(band_indexes))
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return bands, band_masks
 
     def _mask(
-        self, bands, mask_nodata=None, mask_white_areas=None, mask_clouds=None
+        self, bands, band_masks, mask_nodata=None, mask_white_areas=None,
+        mask_clouds=None
     ):
         # if mask_nodata: mask where any band value is 0
-        nodata_mask = (
-            np.any(np.stack([b.mask for b in bands]), axis=0).astype(np.bool)
-            if mask_nodata else None
-        )
+        nodata_mask = band_masks.any(axis=0) if mask_nodata else None
         # TODO: use original vector mask for nodata values
         # nodata_mask = (
         #     geometry_mask(
@@ -254,27 +379,19 @@ class InputTile(base.InputTile):
         #     if mask_nodata and self.nodatamask else None
         # )
 
-        # if mask_clouds: rasterize vector cloud mask
-        cloud_mask = geometry_mask(
-                self.cloudmask, self.tile.shape, self.tile.affine, invert=True
-            ) if mask_clouds and self.cloudmask else None
+        # if mask_clouds: use rasterized vector cloud mask
+        cloud_mask = self._cloud_mask_raster if mask_clouds else None
 
         # if mask_white_areas: mask where all band values are >=4096
-        white_mask = (
-            np.all(
-                np.stack([np.where(b >= 4096, True, False) for b in bands]),
-                axis=0
-            ).astype(np.bool)
-            if mask_white_areas else None
-        )
+        white_mask = (bands >= 4096).all(axis=0) if mask_white_areas else None
         # combine all masks
         masks = [
             m for m in [nodata_mask, cloud_mask, white_mask] if m is not None
         ]
         if masks:
-            return np.any(np.stack(masks), axis=0).astype(np.bool)
+            return functools.reduce(np.logical_or, masks)
         else:
-            return np.zeros(self.tile.shape).astype(np.bool)
+            return np.zeros(self.tile.shape, dtype=bool)
 
     def _get_band_indexes(self, indexes=None):
         """Return valid band indexes."""
@@ -285,3 +402,163 @@ class InputTile(base.InputTile):
                 return [indexes]
         else:
             return range(1, 14)
+
+
+def _read_threads():
+    """
+    Return number of threads used to read bands of one tile.
+
+    Bands are read sequentially unless MAPCHETE_SAFE_READ_THREADS is set, as
+    mapchete usually already processes tiles in one process per CPU. This is
+    independent of GDAL_NUM_THREADS, which the JPEG2000 driver uses for
+    decoding each band.
+    """
+    num_threads = os.environ.get("MAPCHETE_SAFE_READ_THREADS")
+    if num_threads is None:
+        return 1
+    elif num_threads.upper() == "ALL_CPUS":
+        return multiprocessing.cpu_count()
+    try:
+        return max(1, int(num_threads))
+    except ValueError:
+        raise ValueError(
+            "MAPCHETE_SAFE_READ_THREADS must be an integer or ALL_CPUS, "
+            "not %r" % num_threads
+        )
+
+
+def _read_executor():
+    """Return thread pool shared by all tiles read in this process."""
+    global _executor
+    _reset_after_fork()
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != _read_threads():
+            # a replaced pool is not shut down, as other threads may still
+            # submit to it; its threads exit once it is garbage collected
+            _executor = ThreadPoolExecutor(max_workers=_read_threads())
+        return _executor
+
+
+def _read_band_window(path, tile, resampling="nearest"):
+    """Read first band of path reprojected to tile as masked array."""
+    with _cached_dataset(path) as dataset:
+        data = np.concatenate([
+            _reproject_part(dataset, tile, left, width, resampling)
+            for left, width in _antimeridian_parts(tile)
+        ], axis=1)
+    return ma.masked_array(data, mask=data == 0)
+
+
+def _reproject_part(dataset, tile, left, width, resampling):
+    """Reproject first band of dataset to tile columns starting at left."""
+    data = np.zeros((tile.height, width), dtype=dataset.dtypes[0])
+    reproject(
+        source=rasterio.band(dataset, 1),
+        destination=data,
+        src_nodata=0,
+        dst_transform=Affine.translation(left - tile.affine.c, 0) * (
+            tile.affine
+        ),
+        dst_crs=tile.crs,
+        dst_nodata=0,
+        resampling=Resampling[resampling]
+    )
+    return data
+
+
+def _antimeridian_parts(tile):
+    """
+    Return left bound and width in pixels of tile parts from west to east.
+
+    Like mapchete's read_raster_window, buffered tiles of global pyramids
+    going over the antimeridian are split there and the parts beyond are read
+    from the other side of the pyramid.
+    """
+    left, _, right, _ = tile.bounds
+    pyramid = tile.tile_pyramid
+    if not (tile.pixelbuffer and pyramid.is_global) or (
+        pyramid.left <= left and right <= pyramid.right
+    ):
+        return [(left, tile.width)]
+    edges = [left] + [
+        edge for edge in (pyramid.left, pyramid.right) if left < edge < right
+    ] + [right]
+    offsets = [int(round((edge - left) / tile.affine.a)) for edge in edges]
+    parts = []
+    for part_left, start, stop in zip(edges, offsets[:-1], offsets[1:]):
+        if part_left < pyramid.left:
+            part_left += pyramid.right - pyramid.left
+        elif part_left >= pyramid.right:
+            part_left -= pyramid.right - pyramid.left
+        parts.append((part_left, stop - start))
+    return parts
+
+
+@contextmanager
+def _cached_dataset(path):
+    """Yield cached open dataset of path, opening it if necessary."""
+    entry = _acquire_dataset(path)
+    try:
+        # a dataset handle must not be used by more than one thread at a time
+        with entry["lock"]:
+            yield entry["dataset"]
+    finally:
+        _release_dataset(entry)
+
+
+def _acquire_dataset(path):
+    """Return cache entry of path and register current thread as user."""
+    _reset_after_fork()
+    with _datasets_lock:
+        if path in _datasets:
+            # mark as most recently used
+            entry = _datasets[path] = _datasets.pop(path)
+            entry["users"] += 1
+            return entry
+    # open outside of lock so other threads can open other datasets
+    dataset = rasterio.open(path)
+    with _datasets_lock:
+        if path in _datasets:
+            # dataset was opened by another thread in the meantime
+            dataset.close()
+            entry = _datasets[path] = _datasets.pop(path)
+        else:
+            entry = _datasets[path] = dict(
+                dataset=dataset, lock=threading.Lock(), users=0
+            )
+        entry["users"] += 1
+        _evict_datasets()
+        return entry
+
+
+def _release_dataset(entry):
+    """Unregister current thread as user of cache entry."""
+    with _datasets_lock:
+        entry["users"] -= 1
+        _evict_datasets()
+
+
+def _evict_datasets():
+    """Close least recently used datasets which are not in use."""
+    unused = [path for path, entry in _datasets.items() if not entry["users"]]
+    for path in unused[:max(0, len(_datasets) - DATASET_CACHE_SIZE)]:
+        _datasets.pop(path)["dataset"].close()
+
+
+def _reset_after_fork():
+    """Drop datasets, thread pool and locks inherited from parent process."""
+    global _datasets, _datasets_lock, _executor, _executor_lock, _pid
+    if _pid != os.getpid():
+        _datasets, _datasets_lock = OrderedDict(), threading.Lock()
+        _executor, _executor_lock = None, threading.Lock()
+        _pid = os.getpid()
+
+
+@atexit.register
+def _close_datasets():
+    """Close all cached datasets."""
+    with _datasets_lock:
+        while _datasets:
+            _, entry = _datasets.popitem()
+            with entry["lock"]:
+                entry["dataset"].close()
@@ -0,0 +1,129 @@
+"""Fused pixel kernels for Sentinel-2 RGB enhancement."""
+
+import math
+from numba import njit, prange
+import numpy as np
+
+# float32 constants keep kernel arithmetic in single precision
+_ZERO = np.float32(0.)
+_HALF = np.float32(0.5)
+_ONE = np.float32(1.)
+_TWO = np.float32(2.)
+_U8_MAX = np.float32(255.)
+_U8_SCALE = np.float32(1. / 255.)
+_EPSILON = np.float32(1e-7)
+
+
+@njit(fastmath=True, cache=True)
+def _sigmoidal(value, contrast, bias, sig_min, sig_scale):
+    """Sigmoidal contrast of one value, normalized to 0 to 1."""
+    return (_ONE / (_ONE + math.exp(contrast * (bias - value))) - sig_min) * (
+        sig_scale
+    )
+
+
+@njit(fastmath=True, cache=True)
+def _lookup_tables(r_gamma, g_gamma, b_gamma, contrast, bias):
+    """
+    Return gamma corrected and contrast enhanced values per band.
+
+    Gamma and sigmoidal contrast only depend on the 8 bit input value, so
+    they are computed once per band and value into a (3, 256) table.
+    """
+    if r_gamma <= _ZERO or g_gamma <= _ZERO or b_gamma <= _ZERO:
+        raise ValueError("gamma must be greater than 0")
+    if contrast < _ZERO:
+        raise ValueError("contrast must not be negative")
+
+    if bias == _ZERO:
+        bias = _EPSILON
+    # without contrast the sigmoidal is the identity and cannot be normalized
+    sig_min = _ZERO
+    sig_scale = _ONE
+    if contrast > _ZERO:
+        sig_min = _ONE / (_ONE + math.exp(contrast * bias))
+        sig_scale = _ONE / (
+            _ONE / (_ONE + math.exp(contrast * (bias - _ONE))) - sig_min
+        )
+    lut = np.empty((3, 256), dtype=np.float32)
+    for band, band_gamma in enumerate((r_gamma, g_gamma, b_gamma)):
+        band_exp = _ONE / band_gamma
+        for value in range(256):
+            # scale to 0 to 1 and apply gamma
+            v = (np.float32(value) * _U8_SCALE) ** band_exp
+            # sigmoidal contrast & bias
+            if contrast > _ZERO:
+                v = _sigmoidal(v, contrast, bias, sig_min, sig_scale)
+            # float32 rounding may leave the valid range from 0 to 1
+            lut[band, value] = min(_ONE, max(_ZERO, v))
+    return lut
+
+
+@njit(fastmath=True, cache=True)
+def _enhance_pixel(rgb_u16, mask, lut, sat, out, i, j):
+    """Scale, enhance and mask pixel i, j of rgb_u16 into out."""
+    if mask[i, j]:
+        out[0, i, j] = 0
+        out[1, i, j] = 0
+        out[2, i, j] = 0
+        return
+
+    # scale to 8 bit and look up gamma & sigmoidal values
+    r = lut[0, min(np.int64(rgb_u16[0, i, j]) >> 4, 255)]
+    g = lut[1, min(np.int64(rgb_u16[1, i, j]) >> 4, 255)]
+    b = lut[2, min(np.int64(rgb_u16[2, i, j]) >> 4, 255)]
+
+    # saturation: at constant hue and lightness, scaling HSL saturation
+    # moves each channel linearly away from lightness
+    c_max = max(r, g, b)
+    c_min = min(r, g, b)
+    if c_max > c_min:
+        lightness = (c_max + c_min) * _HALF
+        if lightness > _HALF:
+            s = (c_max - c_min) / (_TWO - c_max - c_min)
+        else:
+            s = (c_max - c_min) / (c_max + c_min)
+        factor = min(sat, _ONE / s)
+        r = lightness + (r - lightness) * factor
+        g = lightness + (g - lightness) * factor
+        b = lightness + (b - lightness) * factor
+
+    # scale back to 8 bit and clip valid values from 1 to 255
+    out[0, i, j] = min(_U8_MAX, max(_ONE, r * _U8_MAX))
+    out[1, i, j] = min(_U8_MAX, max(_ONE, g * _U8_MAX))
+    out[2, i, j] = min(_U8_MAX, max(_ONE, b * _U8_MAX))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def enhance_rgb(
+    rgb_u16, mask, r_gamma, g_gamma, b_gamma, contrast, bias, sat, out
+):
+    """
+    Scale, enhance and mask a 12 bit RGB tile in one pass.
+
+    Per pixel this applies the same steps as the rio-color operations: scale
+    to 8 bit, per band gamma correction, sigmoidal contrast, saturation and
+    masking. Saturation is scaled in HSL space.
+
+    Parameters
+    ----------
+    rgb_u16 : 3D uint16 array
+        red, green and blue band
+    mask : 2D bool array
+        nodata mask; masked pixels are set to 0
+    r_gamma, g_gamma, b_gamma : np.float32
+        gamma value per band (must be greater than 0)
+    contrast : np.float32
+        sigmoidal contrast (must not be negative)
+    bias : np.float32
+        sigmoidal bias
+    sat : np.float32
+        saturation factor
+    out : 3D uint8 array
+        output array with the same shape as rgb_u16
+    """
+    lut = _lookup_tables(r_gamma, g_gamma, b_gamma, contrast, bias)
+    height, width = mask.shape
+    for i in prange(height):
+        for j in range(width):
+            _enhance_pixel(rgb_u16, mask, lut, sat, out, i, j)
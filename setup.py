@@ -11,11 +11,15 @@ setup(
     url='https://github.com/ungarj/mapchete-safe',
     license='MIT',
     packages=['mapchete_safe'],
+    # RGB enhancement kernel, if built with build_kernel.py
+    package_data={'mapchete_safe': ['_rgb_enhance*.so', '_rgb_enhance*.pyd']},
     install_requires=[
         'mapchete>=0.13',
         's2reader>=0.4',
-        'cached_property'
+        'cached_property',
+        'futures; python_version < "3"'
         ],
+    extras_require={'numba': ['numba']},
     entry_points={'mapchete.formats.drivers': ['safe=mapchete_safe']},
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""Test RGB enhancement of the example process."""
+
+import colorsys
+import pytest
+import os
+import numpy as np
+import numpy.ma as ma
+
+SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
+EXAMPLE_PROCESS = os.path.join(
+    SCRIPTDIR, "..", "example", "example_process.py"
+)
+
+
+def _load_example_process():
+    """Import example process from its path."""
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # Python 2
+        from imp import load_source
+        return load_source("rgb_example_process", EXAMPLE_PROCESS)
+    spec = spec_from_file_location("rgb_example_process", EXAMPLE_PROCESS)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+example_process = _load_example_process()
+
+
+class _Process(object):
+    """Stand-in for the process object passed to execute()."""
+
+    def __init__(self, **params):
+        self.params = params
+
+
+def _params(contrast=8., bias=0.4, sat=1.3):
+    return dict(
+        red_gamma=1.2, green_gamma=1.2, blue_gamma=1.1,
+        sigmoidal_contrast=contrast, sigmoidal_bias=bias, saturation=sat
+    )
+
+
+def _test_rgb():
+    """12 bit RGB test tile and its nodata mask."""
+    rgb = np.random.RandomState(42).randint(
+        0, 4096, (3, 4, 5)
+    ).astype("uint16")
+    # grey pixels, where saturation is 0
+    rgb[:, 0, 0] = 0
+    rgb[:, 0, 1] = 2000
+    rgb[:, 0, 2] = 4095
+    # values above 12 bit
+    rgb[:, 1, 0] = (65535, 5000, 4096)
+    rgb[:, 1, 1] = (4100, 800, 300)
+    mask = np.zeros(rgb.shape[1:], dtype=bool)
+    mask[2, 2] = True
+    mask[3, 4] = True
+    return rgb, mask
+
+
+def _rio_color_gamma(value, g):
+    """Gamma correction as in rio_color.operations.gamma."""
+    return value ** (1. / g)
+
+
+def _rio_color_sigmoidal(value, contrast, bias):
+    """Sigmoidal contrast as in rio_color.operations.sigmoidal."""
+    if bias == 0:
+        bias = np.finfo(np.float64).eps
+    if contrast == 0:
+        return value
+    sig_min = 1. / (1. + np.exp(contrast * bias))
+    return (1. / (1. + np.exp(contrast * (bias - value))) - sig_min) / (
+        1. / (1. + np.exp(contrast * (bias - 1.))) - sig_min
+    )
+
+
+def _reference(rgb, mask, params):
+    """Enhance pixel by pixel in float64, converting to HSL and back."""
+    gammas = [params["red_gamma"], params["green_gamma"], params["blue_gamma"]]
+    out = np.zeros(rgb.shape, dtype="uint8")
+    for i, j in np.ndindex(mask.shape):
+        if mask[i, j]:
+            continue
+        pixel = [
+            _rio_color_sigmoidal(
+                _rio_color_gamma(min(int(value) >> 4, 255) / 255., g),
+                params["sigmoidal_contrast"],
+                params["sigmoidal_bias"]
+            )
+            for value, g in zip(rgb[:, i, j], gammas)
+        ]
+        hue, lightness, saturation = colorsys.rgb_to_hls(*pixel)
+        pixel = colorsys.hls_to_rgb(
+            hue, lightness, min(saturation * params["saturation"], 1.)
+        )
+        out[:, i, j] = [min(255., max(1., value * 255.)) for value in pixel]
+    return out
+
+
+def _assert_close(result, expected):
+    # float32 rounding may move values across an 8 bit step
+    assert result.dtype == np.uint8
+    assert result.shape == expected.shape
+    assert np.abs(result.astype(int) - expected).max() <= 1
+
+
+PARAMS = [_params(), _params(bias=0.), _params(contrast=0.)]
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_enhance_numpy(params):
+    """NumPy fallback matches rio-color formulas and HSL saturation."""
+    rgb, mask = _test_rgb()
+    expected = _reference(rgb, mask, params)
+    result = example_process._enhance_numpy(
+        _Process(**params),
+        ma.masked_array(
+            rgb.copy(), mask=np.repeat(mask[np.newaxis], 3, axis=0)
+        )
+    )
+    _assert_close(result, expected)
+    assert not result[:, mask].any()
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_enhance_kernel(params):
+    """Fused kernel matches NumPy fallback."""
+    pytest.importorskip("numba")
+    from mapchete_safe._kernels import enhance_rgb
+
+    rgb, mask = _test_rgb()
+    expected = example_process._enhance_numpy(
+        _Process(**params),
+        ma.masked_array(
+            rgb.copy(), mask=np.repeat(mask[np.newaxis], 3, axis=0)
+        )
+    )
+    out = np.empty(rgb.shape, dtype="uint8")
+    enhance_rgb(
+        rgb,
+        mask,
+        np.float32(params["red_gamma"]),
+        np.float32(params["green_gamma"]),
+        np.float32(params["blue_gamma"]),
+        np.float32(params["sigmoidal_contrast"]),
+        np.float32(params["sigmoidal_bias"]),
+        np.float32(params["saturation"]),
+        out
+    )
+    _assert_close(out, expected)
+    _assert_close(out, _reference(rgb, mask, params))
+    assert not out[:, mask].any()
+
+
+def _hls(rgb):
+    """HLS values of all pixels of a 3 band array."""
+    return np.array([
+        colorsys.rgb_to_hls(*pixel)
+        for pixel in rgb.reshape(3, -1).T.astype(np.float64)
+    ])
+
+
+@pytest.mark.parametrize("sat", [0.5, 1.3, 5.])
+def test_saturation(sat):
+    """Saturation keeps hue and lightness and is clamped to 1."""
+    rgb = np.random.RandomState(42).rand(3, 8, 8).astype(np.float32)
+    # grey pixels
+    rgb[:, 0, 0] = 0.
+    rgb[:, 0, 1] = 0.5
+    rgb[:, 0, 2] = 1.
+    before = _hls(rgb)
+    example_process._saturation_inplace(
+        rgb, sat, np.empty(rgb.shape, dtype=np.float32)
+    )
+    assert np.isfinite(rgb).all()
+    after = _hls(rgb)
+
+    hue_diff = np.abs(after[:, 0] - before[:, 0])
+    hue_diff = np.minimum(hue_diff, 1. - hue_diff)
+    colored = before[:, 2] > 1e-3
+    assert (hue_diff[colored] < 1e-3).all()
+    assert np.allclose(after[:, 1], before[:, 1], atol=1e-5)
+    assert np.allclose(
+        after[:, 2], np.minimum(before[:, 2] * sat, 1.), atol=1e-4
+    )
+    # grey pixels stay unchanged
+    assert (rgb[:, 0, 0] == 0.).all()
+    assert (rgb[:, 0, 1] == 0.5).all()
+    assert (rgb[:, 0, 2] == 1.).all()
@@ -3,13 +3,87 @@
 
 import pytest
 import os
+import pickle
+import numpy as np
+import numpy.ma as ma
+import rasterio
 from rasterio.errors import RasterioIOError
+from rasterio.transform import from_bounds
 
 import mapchete
+import mapchete_safe
 from mapchete.formats import available_input_formats, base
+from mapchete.io.raster import read_raster_window
+from mapchete.tile import BufferedTilePyramid
 
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
-EXAMPLE_MAPCHETE = os.path.join(*[SCRIPTDIR, "testdata", "example.mapchete"])
+EXAMPLE_MAPCHETE = os.path.join(SCRIPTDIR, "testdata", "example.mapchete")
+
+
+@pytest.fixture(scope="module")
+def mp_process():
+    """Example Mapchete process opened once for all tests of this module."""
+    with mapchete.open(EXAMPLE_MAPCHETE) as mp:
+        yield mp
+
+
+@pytest.fixture(scope="module")
+def get_tile(mp_process):
+    """Return function opening input tiles, reusing already opened tiles."""
+    opened_tiles = {}
+
+    def _get_tile(tile_index):
+        if tile_index not in opened_tiles:
+            config = mp_process.config.at_zoom(tile_index[0])
+            opened_tiles[tile_index] = config["input"]["s2"].open(
+                mp_process.config.process_pyramid.tile(*tile_index)
+            )
+        return opened_tiles[tile_index]
+
+    return _get_tile
+
+
+class _FakeDataset(object):
+    """Stand-in for rasterio datasets recording whether it was closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def dataset_cache(monkeypatch):
+    """Empty dataset cache holding two fake datasets."""
+    mapchete_safe._close_datasets()
+    monkeypatch.setattr(mapchete_safe, "DATASET_CACHE_SIZE", 2)
+    monkeypatch.setattr(mapchete_safe.rasterio, "open", _FakeDataset)
+    yield
+    mapchete_safe._close_datasets()
+
+
+@pytest.fixture
+def open_stubbed_tile(mp_process, monkeypatch):
+    """Return function opening a new input tile with stubbed band reads."""
+    # test dataset does not contain JP2 files, so provide band data
+    def _read_band_window(path, tile, resampling):
+        return ma.masked_array(np.ones(tile.shape, dtype="uint16"))
+    monkeypatch.setattr(mapchete_safe, "_read_band_window", _read_band_window)
+
+    def _open_stubbed_tile(tile_index=(13, 241, 1098), granule_indexes=None):
+        input_data = mp_process.config.at_zoom(tile_index[0])["input"]["s2"]
+        if granule_indexes is not None:
+            monkeypatch.setattr(
+                input_data, "_intersecting_granule_indexes",
+                lambda geometry: granule_indexes
+            )
+        return input_data.open(
+            mp_process.config.process_pyramid.tile(*tile_index)
+        )
+
+    return _open_stubbed_tile
 
 
 def test_format_available():
@@ -22,44 +96,164 @@ def test_load_input():
     mapchete.open(EXAMPLE_MAPCHETE)
 
 
-def test_input_data():
+def test_input_data(mp_process):
     """Input object properties and methods."""
     zoom = 13
-    with mapchete.open(EXAMPLE_MAPCHETE) as mp:
-        config = mp.config.at_zoom(zoom)
-        assert config["input"]["s2"].path
-        assert config["input"]["s2"].exists()
-        assert config["input"]["s2"].bbox().is_valid
-        assert isinstance(config["input"]["s2"].cloudmask, list)
-        for mask in config["input"]["s2"].cloudmask:
-            assert mask.is_valid
+    config = mp_process.config.at_zoom(zoom)
+    assert config["input"]["s2"].path
+    assert config["input"]["s2"].exists()
+    assert config["input"]["s2"].bbox().is_valid
+    assert isinstance(config["input"]["s2"].cloudmask, list)
+    for mask in config["input"]["s2"].cloudmask:
+        assert mask.is_valid
+    # granule footprints are available in pyramid CRS and EPSG:4326
+    for granule in config["input"]["s2"].s2metadata["granules"]:
+        assert granule["footprint"].is_valid
+        assert granule["footprint_4326"].is_valid
+
 
+def test_input_data_pickle(mp_process):
+    """Input object can be sent to worker processes and open tiles there."""
+    input_data = pickle.loads(
+        pickle.dumps(mp_process.config.at_zoom(13)["input"]["s2"])
+    )
+    pyramid = mp_process.config.process_pyramid
+    assert not input_data.open(pyramid.tile(13, 241, 1098)).is_empty()
+    assert input_data.open(pyramid.tile(13, 0, 0)).is_empty()
 
-def test_input_tile():
+
+def test_input_tile(get_tile):
     """Input tile properties and methods."""
-    test_tile = (13, 241, 1098)
-    with mapchete.open(EXAMPLE_MAPCHETE) as mp:
-        config = mp.config.at_zoom(test_tile[0])
-        tile = config["input"]["s2"].open(
-            mp.config.process_pyramid.tile(*test_tile)
+    tile = get_tile((13, 241, 1098))
+    assert isinstance(tile, base.InputTile)
+    assert not tile.is_empty()
+    # all read() related functions will raise an RasterioIOError because
+    # test dataset does not contain JP2 files
+    with pytest.raises(RasterioIOError):
+        tile.read()
+    assert tile.cloudmask
+    for mask in tile.cloudmask:
+        assert mask.is_valid
+
+
+@pytest.mark.parametrize("num_threads", [None, "2"])
+def test_input_tile_multiple_granules(
+    open_stubbed_tile, monkeypatch, num_threads
+):
+    """Read one band per index when tile covers more than one granule."""
+    if num_threads is None:
+        monkeypatch.delenv("MAPCHETE_SAFE_READ_THREADS", raising=False)
+    else:
+        monkeypatch.setenv("MAPCHETE_SAFE_READ_THREADS", num_threads)
+    # let the tile cover the same granule twice
+    tile = open_stubbed_tile(granule_indexes=[0, 0])
+    assert len(tile.granules) == 2
+    band_indexes = [4, 3, 2]
+    data = tile.read(band_indexes)
+    assert data.shape == (len(band_indexes), ) + tile.tile.shape
+    assert not data.mask.any()
+
+
+def test_input_tile_read_empty(open_stubbed_tile):
+    """Empty reads return masked arrays of requested bands."""
+    tile = open_stubbed_tile(granule_indexes=[])
+    data = tile.read([4, 3, 2], return_empty=True)
+    assert data.shape == (3, ) + tile.tile.shape
+    assert data.dtype == np.uint16
+    assert data.mask.all()
+
+
+def test_read_threads(monkeypatch):
+    """Bands are read sequentially unless MAPCHETE_SAFE_READ_THREADS is set."""
+    monkeypatch.delenv("MAPCHETE_SAFE_READ_THREADS", raising=False)
+    assert mapchete_safe._read_threads() == 1
+    monkeypatch.setenv("MAPCHETE_SAFE_READ_THREADS", "3")
+    assert mapchete_safe._read_threads() == 3
+    monkeypatch.setenv("MAPCHETE_SAFE_READ_THREADS", "ALL_CPUS")
+    assert mapchete_safe._read_threads() >= 1
+    monkeypatch.setenv("MAPCHETE_SAFE_READ_THREADS", "many")
+    with pytest.raises(ValueError):
+        mapchete_safe._read_threads()
+
+
+def test_read_executor(monkeypatch):
+    """Thread pool is reused and resized if the thread setting changes."""
+    monkeypatch.setenv("MAPCHETE_SAFE_READ_THREADS", "2")
+    executor = mapchete_safe._read_executor()
+    assert mapchete_safe._read_executor() is executor
+    monkeypatch.setenv("MAPCHETE_SAFE_READ_THREADS", "3")
+    assert mapchete_safe._read_executor() is not executor
+
+
+def test_dataset_cache(dataset_cache):
+    """Datasets are reused and least recently used ones are closed."""
+    with mapchete_safe._cached_dataset("a") as a:
+        pass
+    with mapchete_safe._cached_dataset("a") as dataset:
+        assert dataset is a
+    for path in ["b", "c"]:
+        with mapchete_safe._cached_dataset(path):
+            pass
+    assert a.closed
+    assert list(mapchete_safe._datasets) == ["b", "c"]
+
+
+def test_dataset_cache_in_use(dataset_cache):
+    """Datasets in use by a thread are not closed when evicting."""
+    with mapchete_safe._cached_dataset("a") as a:
+        for path in ["b", "c", "d"]:
+            with mapchete_safe._cached_dataset(path):
+                pass
+        assert not a.closed
+    with mapchete_safe._cached_dataset("e"):
+        pass
+    assert a.closed
+
+
+def test_dataset_cache_after_fork(dataset_cache, monkeypatch):
+    """Forked processes do not reuse datasets of their parent."""
+    with mapchete_safe._cached_dataset("a") as a:
+        pass
+    # pretend to run in a forked child process
+    monkeypatch.setattr(mapchete_safe, "_pid", None)
+    with mapchete_safe._cached_dataset("a") as dataset:
+        assert dataset is not a
+
+
+def test_read_band_window(tmpdir):
+    """Band windows match mapchete's reader, also across the antimeridian."""
+    path = str(tmpdir.join("band.tif"))
+    with rasterio.open(
+        path, "w", driver="GTiff", width=360, height=180, count=1,
+        dtype="uint16", crs="EPSG:4326",
+        transform=from_bounds(-180, -90, 180, 90, 360, 180)
+    ) as dst:
+        # pixel values are the degree columns counted from the antimeridian
+        dst.write(np.tile(np.arange(1, 361, dtype="uint16"), (1, 180, 1)))
+    try:
+        tile = BufferedTilePyramid("geodetic").tile(5, 10, 10)
+        assert np.array_equal(
+            mapchete_safe._read_band_window(path, tile),
+            read_raster_window(
+                path, tile, indexes=1, src_nodata=0, dst_nodata=0
+            )
         )
-        assert isinstance(tile, base.InputTile)
-        assert not tile.is_empty()
-        # all read() related functions will raise an RasterioIOError because
-        # test dataset does not contain JP2 files
-        with pytest.raises(RasterioIOError):
-            tile.read()
-        assert tile.cloudmask
-        for mask in tile.cloudmask:
-            assert mask.is_valid
-
-
-def test_empty_input_tile():
+        # buffered tiles going over the antimeridian in the west and east
+        pyramid = BufferedTilePyramid("geodetic", pixelbuffer=2)
+        west = mapchete_safe._read_band_window(path, pyramid.tile(5, 10, 0))
+        east = mapchete_safe._read_band_window(path, pyramid.tile(5, 10, 63))
+        for data in [west, east]:
+            assert data.shape == pyramid.tile(5, 10, 0).shape
+            assert not data.mask.any()
+        assert (west[:, :2] == 360).all()
+        assert (west[:, 2:] <= 6).all()
+        assert (east[:, :-2] >= 355).all()
+        assert (east[:, -2:] == 1).all()
+    finally:
+        mapchete_safe._close_datasets()
+
+
+def test_empty_input_tile(get_tile):
     """Empty Input tile properties and methods."""
-    zoom = 13
-    with mapchete.open(EXAMPLE_MAPCHETE) as mp:
-        config = mp.config.at_zoom(zoom)
-        tile = config["input"]["s2"].open(
-            mp.config.process_pyramid.tile(zoom, 0, 0)
-        )
-        assert tile.is_empty()
+    tile = get_tile((13, 0, 0))
+    assert tile.is_empty()
@@ -24,7 +24,10 @@ class Process(MapcheteProcess):
             if raster_file.is_empty(1):
                 return "empty"
 
-            return [
-                np.clip(band, 0, 255)
-                for band in raster_file.read([4, 3, 2])
-            ]
+            # read all bands with one call as (bands, height, width) array
+            bands = raster_file.read([4, 3, 2])
+            assert isinstance(bands, np.ndarray) and bands.ndim == 3
+            # clip all bands at once; uint8 data cannot exceed 0 to 255
+            if bands.dtype != np.uint8:
+                np.clip(bands, 0, 255, out=bands)
+            return bands